@@ -0,0 +1,279 @@
+"""Load generator for the REST API of Misty robots
+
+
+SCL <scott@rerobots.net>
+Copyright (c) 2020 rerobots, Inc.
+"""
+from __future__ import absolute_import
+from __future__ import division
+import json
+import math
+import random
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+import requests
+
+
+DEFAULT_ENDPOINTS = ['/api/skills']
+
+
+def parse_endpoint(spec):
+    """Parse endpoint given as PATH[:WEIGHT]
+
+    Return (path, weight). Weight is a positive integer, default 1.
+    """
+    path, sep, weight = spec.rpartition(':')
+    if not sep:
+        path, weight = spec, '1'
+    try:
+        weight = int(weight)
+    except ValueError:
+        raise ValueError('weight of endpoint must be an integer: {}'.format(spec))
+    if weight < 1:
+        raise ValueError('weight of endpoint must be positive: {}'.format(spec))
+    if not path.startswith('/'):
+        path = '/' + path
+    return path, weight
+
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of already sorted values
+    """
+    if len(sorted_values) == 0:
+        return None
+    k = int(math.ceil(p / 100.0 * len(sorted_values))) - 1
+    k = max(0, min(k, len(sorted_values) - 1))
+    return sorted_values[k]
+
+
+def _worker(addr, mix, deadline, stop_event, timeout, samples):
+    # One session per worker, so that each keeps its own persistent connection.
+    session = requests.Session()
+    try:
+        while time.time() < deadline and not stop_event.is_set():
+            path = random.choice(mix)
+            t0 = time.time()
+            try:
+                res = session.get(addr + path, timeout=timeout)
+                res.content  # read entire body before stopping the clock
+                error = None if res.ok else 'HTTP {}'.format(res.status_code)
+            except requests.exceptions.Timeout:
+                error = 'timeout'
+            except requests.exceptions.ConnectionError:
+                error = 'connection error'
+            except requests.exceptions.RequestException as e:
+                error = type(e).__name__
+            samples.append((path, time.time() - t0, error))
+    finally:
+        session.close()
+
+
+def _battery_sampler(addr, interval, stop_event, timeout, samples):
+    session = requests.Session()
+    try:
+        while not stop_event.is_set():
+            try:
+                res = session.get(addr + '/api/battery', timeout=timeout)
+                if res.ok:
+                    result = res.json().get('result', {})
+                    samples.append((time.time(), result.get('chargePercent'), result.get('current')))
+            except (requests.exceptions.RequestException, ValueError):
+                pass
+            stop_event.wait(interval)
+    finally:
+        session.close()
+
+
+def run(addr, endpoints=None, concurrency=1, duration=10, battery_interval=None, timeout=10):
+    """Send requests to the robot at addr from concurrent workers for duration seconds
+
+    endpoints is a list of (path, weight). If battery_interval is not None,
+    then /api/battery is also sampled every battery_interval seconds.
+
+    If interrupted (KeyboardInterrupt), then workers are stopped, and
+    results collected so far are returned.
+
+    Return dict of results, which can be formatted with report().
+    """
+    if endpoints is None:
+        endpoints = [(path, 1) for path in DEFAULT_ENDPOINTS]
+    mix = []
+    for path, weight in endpoints:
+        mix.extend([path] * weight)
+
+    worker_samples = [[] for k in range(concurrency)]
+    battery_samples = []
+    stop_event = threading.Event()
+    battery_thread = None
+    if battery_interval is not None:
+        battery_thread = threading.Thread(target=_battery_sampler,
+                                          args=(addr, battery_interval, stop_event, timeout, battery_samples))
+        battery_thread.daemon = True
+        battery_thread.start()
+
+    t_start = time.time()
+    deadline = t_start + duration
+    workers = []
+    for k in range(concurrency):
+        th = threading.Thread(target=_worker, args=(addr, mix, deadline, stop_event, timeout, worker_samples[k]))
+        th.daemon = True
+        th.start()
+        workers.append(th)
+    interrupted = False
+    try:
+        for th in workers:
+            # Join with timeout, so that KeyboardInterrupt is received
+            while th.is_alive():
+                th.join(0.1)
+    except KeyboardInterrupt:
+        interrupted = True
+    stop_event.set()
+    for th in workers:
+        th.join()
+    elapsed = time.time() - t_start
+
+    if battery_thread is not None:
+        battery_thread.join()
+
+    samples = []
+    for s in worker_samples:
+        samples.extend(s)
+    return {
+        'elapsed': elapsed,
+        'concurrency': concurrency,
+        'interrupted': interrupted,
+        'samples': samples,
+        'battery': battery_samples,
+    }
+
+
+def _summarize(samples, elapsed):
+    latencies = sorted(s[1] for s in samples)
+    errors = dict()
+    for s in samples:
+        if s[2] is not None:
+            errors[s[2]] = errors.get(s[2], 0) + 1
+    n_errors = sum(errors.values())
+    summary = {
+        'requests': len(samples),
+        'throughput': len(samples) / elapsed if elapsed > 0 else 0.0,
+        'error_rate': n_errors / len(samples) if samples else 0.0,
+        'errors': errors,
+    }
+    for p in [50, 90, 99]:
+        summary['p{}'.format(p)] = percentile(latencies, p)
+    summary['max'] = latencies[-1] if latencies else None
+    return summary
+
+
+def _format_summary(summary, indent=''):
+    out = ''
+    out += '{}requests: {}\n'.format(indent, summary['requests'])
+    out += '{}throughput (req/s): {:.2f}\n'.format(indent, summary['throughput'])
+    out += '{}error rate: {:.4f}\n'.format(indent, summary['error_rate'])
+    for k in ['p50', 'p90', 'p99', 'max']:
+        if summary[k] is None:
+            out += '{}latency {} (ms): -\n'.format(indent, k)
+        else:
+            out += '{}latency {} (ms): {:.1f}\n'.format(indent, k, 1000 * summary[k])
+    for kind in sorted(summary['errors']):
+        out += '{}errors ({}): {}\n'.format(indent, kind, summary['errors'][kind])
+    return out
+
+
+def report(results):
+    """Create string (YAML format) that presents results from run()
+    """
+    samples = results['samples']
+    elapsed = results['elapsed']
+    out = 'duration (s): {:.2f}\n'.format(elapsed)
+    out += 'concurrency: {}\n'.format(results['concurrency'])
+    if results['interrupted']:
+        out += 'interrupted: true\n'
+    out += _format_summary(_summarize(samples, elapsed))
+
+    paths = sorted(set(s[0] for s in samples))
+    if len(paths) > 1:
+        out += 'endpoints:\n'
+        for path in paths:
+            out += '    {}:\n'.format(path)
+            out += _format_summary(_summarize([s for s in samples if s[0] == path], elapsed),
+                                   indent=' '*8)
+
+    battery = results['battery']
+    if battery:
+        out += 'battery:\n'
+        out += '    samples: {}\n'.format(len(battery))
+        charge = [b[1] for b in battery if b[1] is not None]
+        if charge:
+            out += '    charge percent (first): {}\n'.format(charge[0])
+            out += '    charge percent (last): {}\n'.format(charge[-1])
+        current = [b[2] for b in battery if b[2] is not None]
+        if current:
+            out += '    current (mean): {:.3f}\n'.format(sum(current) / len(current))
+    return out.rstrip('\n')
+
+
+class _FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path == '/api/skills':
+            result = [{'uniqueId': '00000000-0000-0000-0000-000000000000', 'name': 'fake'}]
+        elif path == '/api/logs':
+            result = '\r\n'.join('fake log line {}'.format(k) for k in range(100))
+        elif path == '/api/battery':
+            result = {'chargePercent': 0.9, 'current': -0.4, 'isCharging': False}
+        elif path == '/api/device':
+            result = {'robotId': 'fake'}
+        else:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = json.dumps({'result': result, 'status': 'Success'}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeServer(object):
+    """Local HTTP server that imitates parts of the Misty REST API
+
+    Useful for checking `mpm bench` without a robot.
+    """
+    def __init__(self, host='127.0.0.1', port=0):
+        self.server = _ThreadingHTTPServer((host, port), _FakeHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    @property
+    def addr(self):
+        host, port = self.server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
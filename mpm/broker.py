@@ -0,0 +1,286 @@
+"""Local pubsub broker that shares one WebSocket to the robot among many clients
+
+The broker holds one upstream connection to /pubsub of the robot. Clients
+connect over a Unix domain socket and send one JSON object per line, e.g.,
+
+    {"Type": "SkillData", "DebounceMS": null}
+
+Subscriptions are deduplicated by (Type, DebounceMS), so the robot is asked
+for each distinct subscription only once, no matter how many clients want
+it. Messages from the robot are sent to each subscribed client, one per
+line. Each client has a bounded buffer; if a client does not keep up, then
+its oldest buffered messages are dropped, and other clients are not affected.
+
+
+SCL <scott@rerobots.net>
+Copyright (c) 2020 rerobots, Inc.
+"""
+from __future__ import absolute_import
+import collections
+import hashlib
+import json
+import os
+import os.path
+import socket
+import tempfile
+import threading
+
+# Backwards-compatibility with Python 2.7
+try:
+    string_types = basestring
+    integer_types = (int, long)
+except NameError:
+    string_types = str
+    integer_types = int
+
+# inline:
+#   websocket    in Broker._run_upstream()
+
+from . import pubsub
+
+
+DEFAULT_BUFFER_SIZE = 1024
+
+
+def socket_path(addr):
+    """Get default path of broker socket for the robot at WebSocket address addr
+    """
+    digest = hashlib.sha1(addr.encode('utf-8')).hexdigest()[:12]
+    if hasattr(os, 'getuid'):
+        name = 'mpm-broker-{}-{}.sock'.format(os.getuid(), digest)
+    else:
+        name = 'mpm-broker-{}.sock'.format(digest)
+    return os.path.join(tempfile.gettempdir(), name)
+
+
+def connect(path, events):
+    """Connect to broker listening at path, and subscribe to events
+
+    events is a list of (event type, debounce in milliseconds or None).
+    Return the connected socket, or None if no broker is listening.
+    """
+    if not hasattr(socket, 'AF_UNIX') or not os.path.exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        sock.close()
+        return None
+    for event_type, debounce_ms in events:
+        sock.sendall((json.dumps({'Type': event_type, 'DebounceMS': debounce_ms}) + '\n').encode('utf-8'))
+    return sock
+
+
+def messages(sock):
+    """Generate messages received from broker on sock
+    """
+    fp = sock.makefile('rb')
+    for line in fp:
+        yield line.decode('utf-8').rstrip('\n')
+
+
+class _Client(object):
+    def __init__(self, sock, buffer_size):
+        self.sock = sock
+        self.keys = set()
+        self.dropped = 0
+        self._buffer = collections.deque(maxlen=buffer_size)
+        self._cond = threading.Condition()
+        self._closed = False
+
+    def push(self, data):
+        with self._cond:
+            if len(self._buffer) == self._buffer.maxlen:
+                self.dropped += 1
+            self._buffer.append(data)
+            self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+
+    def run_writer(self):
+        while True:
+            with self._cond:
+                while not self._buffer and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    break
+                data = b''.join(self._buffer)
+                self._buffer.clear()
+            try:
+                self.sock.sendall(data)
+            except socket.error:
+                # Wake the reader, which removes this client
+                try:
+                    self.sock.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+                break
+
+
+class Broker(object):
+    """Fan out messages from one WebSocket to /pubsub among local clients
+
+    addr is the base WebSocket address of the robot, e.g., ws://192.168.1.30
+    """
+    def __init__(self, addr, path=None, buffer_size=DEFAULT_BUFFER_SIZE):
+        self.addr = addr
+        self.path = socket_path(addr) if path is None else path
+        self.buffer_size = buffer_size
+        self._lock = threading.Lock()
+        self._subscriptions = dict()  # (event type, debounce) -> (event name, set of clients)
+        self._event_names = dict()  # event name -> (event type, debounce)
+        self._counter = 0
+        self._ws = None
+        self._connected = False
+        self._stopped = threading.Event()
+        self._server = None
+
+    def _send_upstream(self, msg):
+        # Call while holding self._lock
+        if not self._connected:
+            # Subscriptions are sent by _on_open() when connected
+            return
+        try:
+            self._ws.send(msg)
+        except Exception:
+            # Connection lost; subscriptions are sent again on reconnect
+            pass
+
+    def _subscribe(self, client, event_type, debounce_ms):
+        key = (event_type, debounce_ms)
+        with self._lock:
+            if key not in self._subscriptions:
+                self._counter += 1
+                event_name = 'mpm{}{}'.format(event_type, self._counter)
+                self._subscriptions[key] = (event_name, set())
+                self._event_names[event_name] = key
+                self._send_upstream(pubsub.subscribe_message(event_type, event_name, debounce_ms=debounce_ms))
+            self._subscriptions[key][1].add(client)
+            client.keys.add(key)
+
+    def _remove(self, client):
+        with self._lock:
+            for key in client.keys:
+                event_name, clients = self._subscriptions[key]
+                clients.discard(client)
+                if len(clients) == 0:
+                    del self._subscriptions[key]
+                    del self._event_names[event_name]
+                    self._send_upstream(pubsub.unsubscribe_message(event_name))
+            client.keys.clear()
+
+    def _on_open(self, ws):
+        with self._lock:
+            self._connected = True
+            for key, (event_name, clients) in self._subscriptions.items():
+                ws.send(pubsub.subscribe_message(key[0], event_name, debounce_ms=key[1]))
+
+    def _on_close(self, ws, *args):
+        with self._lock:
+            self._connected = False
+
+    def _on_error(self, ws, err):
+        if not isinstance(err, KeyboardInterrupt):
+            print('error:', err)
+
+    def _on_message(self, ws, msg):
+        try:
+            event_name = json.loads(msg).get('eventName')
+        except (ValueError, AttributeError):
+            return
+        if '\n' in msg:
+            msg = json.dumps(json.loads(msg))
+        data = (msg + '\n').encode('utf-8')
+        with self._lock:
+            key = self._event_names.get(event_name)
+            if key is None:
+                return
+            clients = list(self._subscriptions[key][1])
+        for client in clients:
+            client.push(data)
+
+    def _run_upstream(self):
+        import websocket
+        while not self._stopped.is_set():
+            self._ws = websocket.WebSocketApp(self.addr + '/pubsub',
+                                              on_open=self._on_open, on_message=self._on_message,
+                                              on_error=self._on_error, on_close=self._on_close)
+            self._ws.run_forever(ping_interval=15)
+            with self._lock:
+                self._connected = False
+            self._stopped.wait(1)
+
+    def _handle(self, conn):
+        client = _Client(conn, self.buffer_size)
+        writer = threading.Thread(target=client.run_writer)
+        writer.daemon = True
+        writer.start()
+        try:
+            for line in conn.makefile('rb'):
+                try:
+                    req = json.loads(line.decode('utf-8'))
+                    event_type = req['Type']
+                    debounce_ms = req.get('DebounceMS')
+                except (ValueError, KeyError, TypeError, AttributeError):
+                    continue
+                # Same values that pubsub.parse_event() allows
+                if not isinstance(event_type, string_types) or not event_type:
+                    continue
+                if debounce_ms is not None:
+                    if isinstance(debounce_ms, bool) or not isinstance(debounce_ms, integer_types) or debounce_ms < 0:
+                        continue
+                self._subscribe(client, event_type, debounce_ms)
+        except socket.error:
+            pass
+        finally:
+            self._remove(client)
+            client.close()
+            writer.join()
+            conn.close()
+
+    def serve_forever(self):
+        """Listen for clients until stop() is called
+
+        Raise ValueError if another broker is already listening at self.path
+        """
+        sock = connect(self.path, [])
+        if sock is not None:
+            sock.close()
+            raise ValueError('broker already listening at {}'.format(self.path))
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(self.path)
+        self._server.listen(16)
+
+        upstream = threading.Thread(target=self._run_upstream)
+        upstream.daemon = True
+        upstream.start()
+        try:
+            while not self._stopped.is_set():
+                try:
+                    conn, _ = self._server.accept()
+                except socket.error:
+                    break
+                th = threading.Thread(target=self._handle, args=(conn,))
+                th.daemon = True
+                th.start()
+        finally:
+            self._stopped.set()
+            if self._ws is not None:
+                self._ws.close()
+            self._server.close()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+    def stop(self):
+        self._stopped.set()
+        if self._server is not None:
+            try:
+                self._server.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
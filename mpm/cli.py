@@ -9,10 +9,13 @@ from __future__ import absolute_import
 from __future__ import print_function
 import argparse
 import glob
+import io
 import json
 import os
 import os.path
 import random
+import signal
+import socket
 import subprocess
 import sys
 import time
@@ -28,10 +31,13 @@ except NameError:
 import requests
 
 # inline:
-#   websocket    if `mpm logskill`
+#   websocket    if `mpm logskill`, `mpm record`, `mpm replay --to`, or `mpm broker`
+#   .bench       if `mpm bench`
 
 from .__init__ import __version__
+from . import broker
 from . import config
+from . import pubsub
 
 
 def _get_logs(addr):
@@ -53,6 +59,77 @@ def _get_logs(addr):
     return [l for l in raw_logdump.split('\r\n') if l]
 
 
+def _find_skill():
+    """Find skill meta file and main JS file under src/
+
+    Return (skillname, skillmeta_path, mainjs_path), or None if not found.
+    """
+    candidate_metafiles = glob.glob(os.path.join('src', '*.json'))
+    candidate_metafiles += glob.glob(os.path.join('src', '*.JSON'))
+
+    for candidate_metafile in candidate_metafiles:
+        candidate_skillname = os.path.basename(candidate_metafile)
+        if candidate_skillname.endswith('.json') or candidate_skillname.endswith('.JSON'):
+            candidate_skillname = candidate_skillname[:-len('.json')]
+        else:
+            continue
+        candidate_mainjsfile = os.path.join('src', '{}.js'.format(candidate_skillname))
+        if not os.path.exists(candidate_mainjsfile):
+            candidate_mainjsfile = os.path.join('src', '{}.JS'.format(candidate_skillname))
+            if not os.path.exists(candidate_mainjsfile):
+                continue
+        return candidate_skillname, candidate_metafile, candidate_mainjsfile
+    return None
+
+
+def _compress_source(mainjs_path):
+    """Compress source file using uglify-js
+
+    Return (path of the compressed file, 0), or (None, nonzero exit code)
+    if compression failed.
+    """
+    newpath = mainjs_path[:-2] + 'min.js'
+    try:
+        rc = subprocess.call(['uglifyjs', '-o', newpath, mainjs_path])
+    except OSError:
+        print('ERROR: error calling uglifyjs. Is it installed?')
+        return None, 1
+    if rc != 0:
+        print('ERROR: failed to compress source file: {}'.format(mainjs_path))
+        return None, rc
+    return newpath, 0
+
+
+def _write_bundle(fp, skillname, skillmeta_path, mainjs_path):
+    """Write skill bundle (zip archive) to file path or file-like object fp
+
+    The bytes written are the same whether fp is a path on disk or
+    an in-memory buffer like io.BytesIO.
+    """
+    zp = zipfile.ZipFile(fp, mode='w')
+    zp.write(skillmeta_path, arcname='{}.json'.format(skillname))
+    zp.write(mainjs_path, arcname='{}.js'.format(skillname))
+    zp.close()
+
+
+def _upload_bundle(addr, filename, fp):
+    try:
+        res = requests.request(method='POST', url=addr + '/api/skills', files={
+            'File': (filename, fp, 'application/zip'),
+            'ImmediatelyApply': (None, 'false'),
+            'OverwriteExisting': (None, 'true'),
+        })
+    except requests.exceptions.ConnectionError:
+        print('failed to connect to the Misty robot!')
+        print('check connection with `mpm config --ping`')
+        return 1
+    if not res.ok:
+        print('failed to upload skill to robot')
+        return 1
+    print(res.text)
+    return 0
+
+
 def main(argv=None):
     if argv is None:
         argv = sys.argv[1:]
@@ -117,6 +194,20 @@ def main(argv=None):
                               action='store_true', default=False,
                               help='print this help message and exit')
 
+    deploy_help = 'build bundle and upload it to Misty robot'
+    deploy_parser = subparsers.add_parser('deploy', description=deploy_help, help=deploy_help, add_help=False)
+    deploy_parser.add_argument('--in-memory', dest='deploy_in_memory',
+                               action='store_true', default=False,
+                               help=('assemble bundle in memory and upload it '
+                                     'without writing to dist/'))
+    deploy_parser.add_argument('--compress', dest='compress_source',
+                               action='store_true', default=False,
+                               help=('compress source code using uglify-js '
+                                     '(https://github.com/mishoo/UglifyJS2)'))
+    deploy_parser.add_argument('-h', '--help', dest='print_deploy_help',
+                               action='store_true', default=False,
+                               help='print this help message and exit')
+
     remove_help = 'remove skill from Misty robot'
     remove_parser = subparsers.add_parser('remove', description=remove_help, help=remove_help, add_help=False)
     remove_parser.add_argument('remove_ID', metavar='ID', default=None, nargs='?',
@@ -152,6 +243,77 @@ def main(argv=None):
                                  action='store_true', default=False,
                                  help='print this help message and exit')
 
+    broker_help = 'share one pubsub WebSocket to Misty robot among local clients'
+    broker_parser = subparsers.add_parser('broker', description=broker_help, help=broker_help, add_help=False)
+    broker_parser.add_argument('--socket', dest='broker_socket',
+                               default=None, metavar='PATH',
+                               help=('path of Unix socket on which to listen; '
+                                     'default is derived from the robot address, '
+                                     'where `mpm logskill` looks for it'))
+    broker_parser.add_argument('--buffer', dest='broker_buffer',
+                               type=int, default=broker.DEFAULT_BUFFER_SIZE, metavar='N',
+                               help=('maximum number of messages buffered per client; '
+                                     'default {}'.format(broker.DEFAULT_BUFFER_SIZE)))
+    broker_parser.add_argument('-h', '--help', dest='print_broker_help',
+                               action='store_true', default=False,
+                               help='print this help message and exit')
+
+    record_help = 'record pubsub events from Misty robot to a file'
+    record_parser = subparsers.add_parser('record', description=record_help, help=record_help, add_help=False)
+    record_parser.add_argument('-e', '--event', dest='record_events',
+                               action='append', default=None, metavar='TYPE[:debounceMS]',
+                               help=('type of event to record, with optional debounce '
+                                     'in milliseconds; may be given more than once; '
+                                     'default SkillData'))
+    record_parser.add_argument('-o', '--output', dest='record_path',
+                               default='events.mpmrec', metavar='FILE',
+                               help=('file to append recording to; '
+                                     'default events.mpmrec'))
+    record_parser.add_argument('-h', '--help', dest='print_record_help',
+                               action='store_true', default=False,
+                               help='print this help message and exit')
+
+    replay_help = 'replay pubsub events from a file created by `mpm record`'
+    replay_parser = subparsers.add_parser('replay', description=replay_help, help=replay_help, add_help=False)
+    replay_parser.add_argument('replay_path', metavar='FILE',
+                               help='recording created by `mpm record`')
+    replay_parser.add_argument('--speed', dest='replay_speed',
+                               type=float, default=1.0, metavar='X',
+                               help=('speed relative to the original timing; '
+                                     '0 to replay as fast as possible; default 1'))
+    replay_parser.add_argument('--to', dest='replay_to',
+                               default=None, metavar='URL',
+                               help='send messages to WebSocket at URL instead of printing them')
+    replay_parser.add_argument('-h', '--help', dest='print_replay_help',
+                               action='store_true', default=False,
+                               help='print this help message and exit')
+
+    bench_help = 'measure request load that Misty robot REST API can handle'
+    bench_parser = subparsers.add_parser('bench', description=bench_help, help=bench_help, add_help=False)
+    bench_parser.add_argument('-c', '--concurrency', dest='bench_concurrency',
+                              type=int, default=4, metavar='N',
+                              help='number of concurrent connections; default 4')
+    bench_parser.add_argument('-d', '--duration', dest='bench_duration',
+                              type=float, default=10, metavar='SECONDS',
+                              help='duration of benchmark in seconds; default 10')
+    bench_parser.add_argument('-e', '--endpoint', dest='bench_endpoints',
+                              action='append', default=None, metavar='PATH[:WEIGHT]',
+                              help=('endpoint to request, with optional integer weight '
+                                    'in the mix; may be given more than once; '
+                                    'default /api/skills'))
+    bench_parser.add_argument('--battery', dest='bench_battery',
+                              type=float, default=None, metavar='SECONDS',
+                              help='also sample /api/battery every SECONDS')
+    bench_parser.add_argument('--timeout', dest='bench_timeout',
+                              type=float, default=10, metavar='SECONDS',
+                              help='timeout of each request; default 10')
+    bench_parser.add_argument('--fake', dest='bench_fake',
+                              action='store_true', default=False,
+                              help='run against a local fake server instead of the robot')
+    bench_parser.add_argument('-h', '--help', dest='print_bench_help',
+                              action='store_true', default=False,
+                              help='print this help message and exit')
+
     mversion_help = 'print (YAML format) identifiers and version numbers of Misty robot and exit.'
     mversion_parser = subparsers.add_parser('mistyversion', description=mversion_help, help=mversion_help, add_help=False)
     mversion_parser.add_argument('-h', '--help', dest='print_mversion_help',
@@ -216,6 +378,8 @@ def main(argv=None):
                 list_parser.print_help()
             elif args.help_target_command == 'upload':
                 upload_parser.print_help()
+            elif args.help_target_command == 'deploy':
+                deploy_parser.print_help()
             elif args.help_target_command == 'remove':
                 remove_parser.print_help()
             elif args.help_target_command == 'skillstart':
@@ -224,6 +388,14 @@ def main(argv=None):
                 log_parser.print_help()
             elif args.help_target_command == 'logskill':
                 logskill_parser.print_help()
+            elif args.help_target_command == 'broker':
+                broker_parser.print_help()
+            elif args.help_target_command == 'record':
+                record_parser.print_help()
+            elif args.help_target_command == 'replay':
+                replay_parser.print_help()
+            elif args.help_target_command == 'bench':
+                bench_parser.print_help()
             elif args.help_target_command == 'mistyversion':
                 mversion_parser.print_help()
             else:
@@ -276,40 +448,16 @@ def main(argv=None):
             return 0
 
         # Preconditions
-        candidate_metafiles = glob.glob(os.path.join('src', '*.json'))
-        candidate_metafiles += glob.glob(os.path.join('src', '*.JSON'))
-
-        skillname = None
-        for candidate_metafile in candidate_metafiles:
-            candidate_skillname = os.path.basename(candidate_metafile)
-            if candidate_skillname.endswith('.json') or candidate_skillname.endswith('.JSON'):
-                candidate_skillname = candidate_skillname[:-len('.json')]
-            else:
-                continue
-            candidate_mainjsfile = os.path.join('src', '{}.js'.format(candidate_skillname))
-            if not os.path.exists(candidate_mainjsfile):
-                candidate_mainjsfile = os.path.join('src', '{}.JS'.format(candidate_skillname))
-                if not os.path.exists(candidate_mainjsfile):
-                    continue
-            skillname = candidate_skillname
-            skillmeta_path = candidate_metafile
-            mainjs_path = candidate_mainjsfile
-            break
-        if skillname is None:
+        skill = _find_skill()
+        if skill is None:
             print('ERROR: no meta file found in src/')
             return 1
+        skillname, skillmeta_path, mainjs_path = skill
 
         if args.compress_source:
-            newpath = mainjs_path[:-2] + 'min.js'
-            try:
-                rc = subprocess.call(['uglifyjs', '-o', newpath, mainjs_path])
-            except OSError:
-                print('ERROR: error calling uglifyjs. Is it installed?')
-                return 1
+            mainjs_path, rc = _compress_source(mainjs_path)
             if rc != 0:
-                print('ERROR: failed to compress source file: {}'.format(mainjs_path))
                 return rc
-            mainjs_path = newpath
 
         # Write results
         if not os.path.exists('dist'):
@@ -317,10 +465,7 @@ def main(argv=None):
         zipout_path = os.path.join('dist', '{}.zip'.format(skillname))
         if os.path.exists(zipout_path):
             print('WARNING: destination file {} already exists. overwriting...'.format(zipout_path))
-        zp = zipfile.ZipFile(zipout_path, mode='w')
-        zp.write(skillmeta_path, arcname='{}.json'.format(skillname))
-        zp.write(mainjs_path, arcname='{}.js'.format(skillname))
-        zp.close()
+        _write_bundle(zipout_path, skillname, skillmeta_path, mainjs_path)
 
     elif args.command == 'clean':
         if args.print_clean_help:
@@ -406,26 +551,51 @@ def main(argv=None):
             print('ERROR: more than one file under dist/')
             print('perhaps `mpm clean`, then `mpm build` again')
             return 1
-        fp = open(dist_files[0], 'rb')
         cfg = config.load()
         addr = cfg.get('addr')
         if not addr.startswith('http'):
             addr = 'http://' + addr
-        try:
-            res = requests.request(method='POST', url=addr + '/api/skills', files={
-                'File': (dist_files[0], fp, 'application/zip'),
-                'ImmediatelyApply': (None, 'false'),
-                'OverwriteExisting': (None, 'true'),
-            })
-        except requests.exceptions.ConnectionError:
-            print('failed to connect to the Misty robot!')
-            print('check connection with `mpm config --ping`')
-            return 1
-        fp.close()
-        if not res.ok:
-            print('failed to upload skill to robot')
+        with open(dist_files[0], 'rb') as fp:
+            rc = _upload_bundle(addr, dist_files[0], fp)
+        if rc != 0:
+            return rc
+
+    elif args.command == 'deploy':
+        if args.print_deploy_help:
+            deploy_parser.print_help()
+            return 0
+
+        skill = _find_skill()
+        if skill is None:
+            print('ERROR: no meta file found in src/')
             return 1
-        print(res.text)
+        skillname, skillmeta_path, mainjs_path = skill
+
+        if args.compress_source:
+            mainjs_path, rc = _compress_source(mainjs_path)
+            if rc != 0:
+                return rc
+
+        cfg = config.load()
+        addr = cfg.get('addr')
+        if not addr.startswith('http'):
+            addr = 'http://' + addr
+
+        bundle_name = '{}.zip'.format(skillname)
+        if args.deploy_in_memory:
+            fp = io.BytesIO()
+            _write_bundle(fp, skillname, skillmeta_path, mainjs_path)
+            fp.seek(0)
+            rc = _upload_bundle(addr, bundle_name, fp)
+        else:
+            if not os.path.exists('dist'):
+                os.mkdir('dist')
+            zipout_path = os.path.join('dist', bundle_name)
+            _write_bundle(zipout_path, skillname, skillmeta_path, mainjs_path)
+            with open(zipout_path, 'rb') as fp:
+                rc = _upload_bundle(addr, bundle_name, fp)
+        if rc != 0:
+            return rc
 
     elif args.command == 'remove':
         if args.print_remove_help:
@@ -540,29 +710,29 @@ def main(argv=None):
             logskill_parser.print_help()
             return 0
 
-        import websocket
-
         cfg = config.load()
-        addr = cfg.get('addr')
-        if addr.startswith('http:'):
-            addr = 'ws:' + addr[5:]
-        elif addr.startswith('https:'):
-            addr = 'wss:' + addr[6:]
-        elif not addr.startswith('http'):
-            addr = 'ws://' + addr
+        addr = pubsub.ws_addr(cfg.get('addr'))
+
+        # If `mpm broker` is running, then share its connection to the robot
+        sock = broker.connect(broker.socket_path(addr), [('SkillData', None)])
+        if sock is not None:
+            try:
+                for msg in broker.messages(sock):
+                    x = json.loads(msg)
+                    print(x['message'])
+            except KeyboardInterrupt:
+                pass
+            finally:
+                sock.close()
+            return 0
+
+        import websocket
 
         def on_open(ws):
-            ws.send(json.dumps({
-                'Operation': 'subscribe',
-                'Type': 'SkillData',
-                'DebounceMS': None,
-                'EventName': 'SkillData{}'.format(random.randint(0,1000)),
-                'Message': '',
-                'ReturnProperty': None,
-            }))
+            ws.send(pubsub.subscribe_message('SkillData', 'SkillData{}'.format(random.randint(0,1000))))
 
         def on_error(ws, err):
-            print('error:', msg)
+            print('error:', err)
 
         def on_message(ws, msg):
             x = json.loads(msg)
@@ -572,6 +742,174 @@ def main(argv=None):
         ws.run_forever(ping_interval=15)
 
 
+    elif args.command == 'broker':
+        if args.print_broker_help:
+            broker_parser.print_help()
+            return 0
+        if args.broker_buffer < 1:
+            print('ERROR: buffer must be at least 1')
+            return 1
+
+        cfg = config.load()
+        addr = pubsub.ws_addr(cfg.get('addr'))
+
+        b = broker.Broker(addr, path=args.broker_socket, buffer_size=args.broker_buffer)
+        print('listening on {}'.format(b.path))
+        sys.stdout.flush()
+        try:
+            b.serve_forever()
+        except ValueError as e:
+            print('ERROR: {}'.format(e))
+            return 1
+        except KeyboardInterrupt:
+            pass
+
+    elif args.command == 'record':
+        if args.print_record_help:
+            record_parser.print_help()
+            return 0
+
+        import websocket
+
+        try:
+            events = [pubsub.parse_event(spec) for spec in (args.record_events or ['SkillData'])]
+        except ValueError as e:
+            print('ERROR: {}'.format(e))
+            return 1
+
+        cfg = config.load()
+        addr = pubsub.ws_addr(cfg.get('addr'))
+
+        recorder = pubsub.Recorder(args.record_path)
+
+        # Subscriptions are made again each time that the connection is opened
+        def on_open(ws):
+            for event_type, debounce_ms in events:
+                event_name = '{}{}'.format(event_type, random.randint(0,1000))
+                ws.send(pubsub.subscribe_message(event_type, event_name, debounce_ms=debounce_ms))
+
+        interrupted = []
+        current_ws = []
+
+        # Stop on SIGTERM (e.g., from systemd) as on Ctrl-C, so the recording is complete
+        def on_sigterm(signum, frame):
+            interrupted.append(True)
+            if current_ws:
+                current_ws[0].keep_running = False
+                # Shut down, not close, so that the waiting dispatcher wakes up
+                try:
+                    current_ws[0].sock.sock.shutdown(socket.SHUT_RDWR)
+                except (AttributeError, OSError):
+                    pass
+        signal.signal(signal.SIGTERM, on_sigterm)
+
+        def on_error(ws, err):
+            if isinstance(err, KeyboardInterrupt):
+                interrupted.append(True)
+            else:
+                print('error:', err)
+
+        def on_message(ws, msg):
+            recorder.put(msg)
+
+        try:
+            while not interrupted:
+                ws = websocket.WebSocketApp(addr + '/pubsub', on_open=on_open, on_message=on_message, on_error=on_error)
+                current_ws[:] = [ws]
+                ws.run_forever(ping_interval=15)
+                if not interrupted:
+                    print('connection to Misty robot closed; reconnecting...')
+                    time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            recorder.close()
+        print('recorded {} messages to {}'.format(recorder.count, args.record_path))
+        if recorder.skipped > 0:
+            print('skipped {} messages that could not be recorded'.format(recorder.skipped))
+
+    elif args.command == 'replay':
+        if args.print_replay_help:
+            replay_parser.print_help()
+            return 0
+        if args.replay_speed < 0:
+            print('ERROR: speed must be nonnegative')
+            return 1
+        if not os.path.exists(args.replay_path):
+            print('ERROR: recording not found: {}'.format(args.replay_path))
+            return 1
+
+        if args.replay_to is None:
+            def send(msg):
+                print(msg)
+                sys.stdout.flush()
+            ws = None
+        else:
+            import websocket
+            try:
+                ws = websocket.create_connection(args.replay_to)
+            except (websocket.WebSocketException, OSError) as e:
+                print('failed to connect to {}: {}'.format(args.replay_to, e))
+                return 1
+            send = ws.send
+
+        try:
+            pubsub.replay(args.replay_path, send, speed=args.replay_speed)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if ws is not None:
+                ws.close()
+
+    elif args.command == 'bench':
+        if args.print_bench_help:
+            bench_parser.print_help()
+            return 0
+
+        from . import bench
+
+        if args.bench_concurrency < 1:
+            print('ERROR: concurrency must be at least 1')
+            return 1
+        if args.bench_battery is not None and args.bench_battery <= 0:
+            print('ERROR: battery sampling interval must be positive')
+            return 1
+        if args.bench_duration <= 0:
+            print('ERROR: duration must be positive')
+            return 1
+        if args.bench_timeout <= 0:
+            print('ERROR: timeout must be positive')
+            return 1
+        if args.bench_endpoints is None:
+            endpoints = None
+        else:
+            try:
+                endpoints = [bench.parse_endpoint(spec) for spec in args.bench_endpoints]
+            except ValueError as e:
+                print('ERROR: {}'.format(e))
+                return 1
+
+        fake_server = None
+        if args.bench_fake:
+            fake_server = bench.FakeServer()
+            fake_server.start()
+            addr = fake_server.addr
+        else:
+            cfg = config.load()
+            addr = cfg.get('addr')
+            if not addr.startswith('http'):
+                addr = 'http://' + addr
+        try:
+            results = bench.run(addr, endpoints=endpoints,
+                                concurrency=args.bench_concurrency,
+                                duration=args.bench_duration,
+                                battery_interval=args.bench_battery,
+                                timeout=args.bench_timeout)
+        finally:
+            if fake_server is not None:
+                fake_server.stop()
+        print(bench.report(results))
+
     elif args.command == 'mistyversion':
         if args.print_mversion_help:
             mversion_parser.print_help()
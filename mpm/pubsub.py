@@ -0,0 +1,216 @@
+"""Routines for subscribing to, recording, and replaying pubsub events
+
+
+SCL <scott@rerobots.net>
+Copyright (c) 2020 rerobots, Inc.
+"""
+from __future__ import absolute_import
+from __future__ import division
+import gzip
+import io
+import json
+import threading
+import time
+import zlib
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+def ws_addr(addr):
+    """Get base WebSocket address from the configured robot address
+    """
+    if addr.startswith('http:'):
+        return 'ws:' + addr[5:]
+    elif addr.startswith('https:'):
+        return 'wss:' + addr[6:]
+    elif not addr.startswith('ws'):
+        return 'ws://' + addr
+    return addr
+
+
+def parse_event(spec):
+    """Parse event given as TYPE[:debounceMS]
+
+    Return (event type, debounce in milliseconds or None).
+    """
+    event_type, sep, debounce_ms = spec.partition(':')
+    if not event_type:
+        raise ValueError('event type is missing: {}'.format(spec))
+    if not sep:
+        return event_type, None
+    try:
+        debounce_ms = int(debounce_ms)
+    except ValueError:
+        raise ValueError('debounce of event must be an integer: {}'.format(spec))
+    if debounce_ms < 0:
+        raise ValueError('debounce of event must be nonnegative: {}'.format(spec))
+    return event_type, debounce_ms
+
+
+def subscribe_message(event_type, event_name, debounce_ms=None):
+    """Create message that subscribes to events of type event_type
+    """
+    return json.dumps({
+        'Operation': 'subscribe',
+        'Type': event_type,
+        'DebounceMS': debounce_ms,
+        'EventName': event_name,
+        'Message': '',
+        'ReturnProperty': None,
+    })
+
+
+def unsubscribe_message(event_name):
+    """Create message that cancels subscription with name event_name
+    """
+    return json.dumps({
+        'Operation': 'unsubscribe',
+        'EventName': event_name,
+        'Message': '',
+    })
+
+
+def _gzip_member(data):
+    """Compress data as one complete gzip member
+    """
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as fp:
+        fp.write(data)
+    return buf.getvalue()
+
+
+def _encode(msg):
+    """Encode message as payload of one line of a recording
+
+    Payloads that could be mistaken for something else (empty, containing
+    a newline, or beginning with a double quote) are written as JSON strings.
+    """
+    if isinstance(msg, bytes):
+        msg = msg.decode('utf-8', 'replace')
+    if not msg or '\n' in msg or '\r' in msg or msg.startswith('"'):
+        msg = json.dumps(msg)
+    return msg
+
+
+def _decode(payload):
+    if payload.startswith('"'):
+        return json.loads(payload)
+    return payload
+
+
+class Recorder(object):
+    """Append timestamped messages to a recording file from a background thread
+
+    The file is gzip-compressed, with one line per message: time of receipt
+    (seconds since the Epoch), a tab, and the message. Each recording session
+    begins with a line that has an empty message. Messages are written every
+    flush_interval seconds as a complete gzip member, so the file remains
+    readable, and can be appended to, even if the process is killed; at most
+    the messages of the last interval are lost.
+
+    put() never blocks, so it is safe to call from WebSocket callbacks.
+    Messages that cannot be encoded are skipped and counted in self.skipped.
+    """
+    def __init__(self, path, flush_interval=1.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.count = 0
+        self.skipped = 0
+        self._queue = queue.Queue()
+        self._fp = open(path, 'ab')
+        self._pending = ['{:.6f}\t\n'.format(time.time()).encode('utf-8')]
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, msg, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        self._queue.put((timestamp, msg))
+
+    def _write_pending(self):
+        if self._pending:
+            self._fp.write(_gzip_member(b''.join(self._pending)))
+            self._fp.flush()
+            self._pending = []
+
+    def _run(self):
+        last_flush = time.time()
+        while True:
+            try:
+                item = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                item = None
+            if item is not None:
+                if item[1] is None:
+                    break
+                timestamp, msg = item
+                try:
+                    line = '{:.6f}\t{}\n'.format(timestamp, _encode(msg)).encode('utf-8')
+                except Exception:
+                    self.skipped += 1
+                else:
+                    self._pending.append(line)
+                    self.count += 1
+            if time.time() - last_flush >= self.flush_interval:
+                self._write_pending()
+                last_flush = time.time()
+        self._write_pending()
+        self._fp.close()
+
+    def close(self):
+        self._queue.put((None, None))
+        self._thread.join()
+
+
+def read_recording(path):
+    """Generate (timestamp, message) from recording file at path
+
+    message is None at the start of each recording session. Malformed lines
+    are skipped, and a truncated or corrupt gzip member ends the recording,
+    without error.
+    """
+    with gzip.open(path, 'rb') as fp:
+        while True:
+            try:
+                line = fp.readline()
+            except (EOFError, OSError, zlib.error):
+                break
+            if not line:
+                break
+            if not line.endswith(b'\n'):
+                break
+            try:
+                timestamp, payload = line.decode('utf-8').rstrip('\n').split('\t', 1)
+                timestamp = float(timestamp)
+                msg = _decode(payload) if payload else None
+            except ValueError:
+                # Malformed line
+                continue
+            yield timestamp, msg
+
+
+def replay(path, send, speed=1.0):
+    """Call send(message) for each message in recording file at path
+
+    Original timing between messages is divided by speed. Timing restarts
+    at each recording session, so gaps between sessions are skipped.
+    If speed is 0, then messages are sent as fast as possible.
+    """
+    t0 = None
+    start = None
+    for timestamp, msg in read_recording(path):
+        if msg is None:
+            t0 = None
+            continue
+        if speed > 0:
+            if t0 is None:
+                t0 = timestamp
+                start = time.time()
+            delay = start + (timestamp - t0) / speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        send(msg)